@@ -4,6 +4,10 @@
 from cog import BasePredictor, Input, Path
 import os
 import re
+import functools
+import hashlib
+import mmap
+import shutil
 import time
 import torch
 import json
@@ -12,13 +16,15 @@ import tempfile
 import tarfile
 import numpy as np
 from types import MethodType
+from concurrent.futures import ThreadPoolExecutor
 from huggingface_hub import hf_hub_download
 from PIL import Image
 from typing import List
 from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
 from diffusers import PNDMScheduler, AutoencoderKL, UNet2DConditionModel
+from diffusers import DPMSolverMultistepScheduler
+from diffusers.models.attention_processor import AttnProcessor2_0
 from transformers import CLIPTextModel, CLIPTokenizer
-from torchvision import transforms
 from weights import WeightsDownloadCache
 from transformers import CLIPImageProcessor
 from lora_loading_patch import load_lora_into_transformer
@@ -26,40 +32,59 @@ from diffusers.pipelines.stable_diffusion.safety_checker import (
     StableDiffusionSafetyChecker
 )
 
-def truncate_prompt(prompt, max_tokens=75):
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
+
+def truncate_prompt(prompt, tokenizer):
     """
-    Truncate the prompt to ensure it doesn't exceed CLIP's token limit.
-    This is a simple approximation - in production you might want a more accurate token counter.
+    Truncate the prompt to CLIP's token limit, counting real BPE tokens
+    (including the start/end tokens) with the pipeline's tokenizer.
     """
-    words = prompt.split()
-    if len(words) <= max_tokens:
+    max_tokens = tokenizer.model_max_length
+    ids = tokenizer(prompt, truncation=False, add_special_tokens=True).input_ids
+    if len(ids) <= max_tokens:
         return prompt
-    
-    return " ".join(words[:max_tokens])
+
+    # Keep the start token plus as many prompt tokens as fit before the end token
+    return tokenizer.decode(ids[:max_tokens - 1], skip_special_tokens=True)
 
 def patch_unet_get_aug_embed(unet):
     import torch
+
+    # SD1.5 UNets have no added embedding, so get_aug_embed is always None
+    if unet.config.addition_embed_type is None:
+        unet.get_aug_embed = lambda *args, **kwargs: None
+        return
+
     original_method = unet.get_aug_embed
+    unet._zeros_text = {}
+    unet._zeros_time = {}
 
     def patched_method(self, *args, **kwargs):
         if "added_cond_kwargs" not in kwargs or kwargs["added_cond_kwargs"] is None:
             kwargs["added_cond_kwargs"] = {}
 
         conds = kwargs["added_cond_kwargs"]
+        batch_size = kwargs["sample"].shape[0] if "sample" in kwargs else 1
+        key = (batch_size, self.device)
 
         if "text_embeds" not in conds:
-            batch_size = kwargs["sample"].shape[0] if "sample" in kwargs else 1
-            conds["text_embeds"] = torch.zeros((batch_size, 1280), device=self.device)
+            if key not in self._zeros_text:
+                self._zeros_text[key] = torch.zeros((batch_size, 1280), device=self.device, dtype=self.dtype)
+            conds["text_embeds"] = self._zeros_text[key]
 
         if "time_ids" not in conds:
-            batch_size = kwargs["sample"].shape[0] if "sample" in kwargs else 1
-            conds["time_ids"] = torch.zeros((batch_size, 6), device=self.device, dtype=torch.long)
+            if key not in self._zeros_time:
+                self._zeros_time[key] = torch.zeros((batch_size, 6), device=self.device, dtype=torch.long)
+            conds["time_ids"] = self._zeros_time[key]
 
         return original_method(*args, **kwargs)
 
     unet.get_aug_embed = MethodType(patched_method, unet)
 
 MAX_IMAGE_SIZE = 1440
+# One dtype for every weight and input so img2img never mixes fp16 and bf16
+DTYPE = torch.float16
 MODEL_CACHE = "cyberrealistic-pony"
 SAFETY_CACHE = "safety-cache"
 FEATURE_EXTRACTOR = "/src/feature-extractor"
@@ -85,44 +110,135 @@ ASPECT_RATIOS = {
     "9:21": (640, 1536),
 }
 
+LORA_HF_SLUG_RE = re.compile(r"^[a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+$")
+LORA_REPLICATE_RE = re.compile(r"^https?://replicate.delivery/[a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+/trained_model.tar")
+LORA_HF_URL_RE = re.compile(r"^https?://huggingface.co/([a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+)")
+LORA_CIVITAI_RE = re.compile(r"^https?://civitai.com/api/download/models/[0-9]+\?type=Model&format=SafeTensor")
+
+LORA_DIGEST_DATA_BYTES = 1 << 20
+
+DOWNLOAD_CONNECTIONS = 8
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# (connect, read) seconds, so a stalled connection fails instead of hanging
+DOWNLOAD_TIMEOUT = (10, 60)
+
+def lora_digest(path):
+    """
+    Fingerprint a safetensors file from its header and the first MiB of tensor
+    data, so identical LoRAs can be recognized without reading the whole file.
+    """
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        data = f.read(header_len + LORA_DIGEST_DATA_BYTES)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def download_range(url, buf, start, end):
+    """
+    Download bytes [start, end] of url into the same slice of buf.
+    Returns False without writing anything if the server ignored the Range header.
+    """
+    response = requests.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()
+        return False
+    offset = start
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    if offset != end + 1:
+        raise IOError(f"Short read for bytes {start}-{end} of {url}: got {offset - start} bytes")
+    return True
+
+def download_stream(url, f):
+    """
+    Download url into the open file f over a single connection.
+    """
+    response = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        f.write(chunk)
+    f.flush()
+
+def download_to_file(url, f):
+    """
+    Download url into the open file f, using parallel byte-range requests
+    when the server supports them and a single stream otherwise.
+    """
+    head = requests.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    size = int(head.headers.get("Content-Length", 0))
+    if head.headers.get("Accept-Ranges") != "bytes" or size == 0:
+        download_stream(url, f)
+        return
+
+    # Pre-allocate the file and let each connection write its own slice
+    f.truncate(size)
+    part = -(-size // DOWNLOAD_CONNECTIONS)
+    ranges = [(a, min(a + part, size) - 1) for a in range(0, size, part)]
+    with mmap.mmap(f.fileno(), size) as buf:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(download_range, head.url, buf, a, b) for a, b in ranges]
+            ranged = all([future.result() for future in futures])
+        buf.flush()
+
+    if not ranged:
+        # Advertised byte ranges but answered 200 with the full body
+        print("Server ignored byte ranges, downloading as a single stream")
+        f.seek(0)
+        f.truncate(0)
+        download_stream(url, f)
+
 def download_weights(url, dest, file=False):
     start = time.time()
     print("downloading url:", url)
     print("downloading to:", dest)
 
     if not file:
-        os.makedirs(dest, exist_ok=True)
-        with tempfile.NamedTemporaryFile(suffix=".tar", delete=False) as tmp_file:
-            response = requests.get(url, stream=True)
-            for chunk in response.iter_content(chunk_size=8192):
-                tmp_file.write(chunk)
-            tmp_file.flush()
-            with tarfile.open(tmp_file.name, "r") as tar:
-                tar.extractall(dest)
+        # Extract next to dest and rename into place only once everything succeeded,
+        # so a failed download never leaves a half-filled dest behind
+        tmp_dest = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(dest)))
+        try:
+            with tempfile.TemporaryFile(suffix=".tar") as tmp_file:
+                download_to_file(url, tmp_file)
+                tmp_file.seek(0)
+                # Streaming mode reads the archive front to back in large blocks
+                with open(tmp_file.fileno(), "rb", buffering=DOWNLOAD_CHUNK_SIZE, closefd=False) as fileobj:
+                    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+                        tar.extractall(tmp_dest)
+            os.rename(tmp_dest, dest)
+        except BaseException:
+            shutil.rmtree(tmp_dest, ignore_errors=True)
+            raise
     else:
         dirname = os.path.dirname(dest)
         if dirname:
             os.makedirs(dirname, exist_ok=True)
-        response = requests.get(url, stream=True)
-        with open(dest, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        with open(dest, 'wb+') as f:
+            download_to_file(url, f)
 
     print("downloading took:", time.time() - start)
 
+# Pillow releases the GIL while encoding, so saves run in parallel across cores
+SAVE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def save_image(image, i, output_format, output_quality):
+    output_path = f"/tmp/out-{i}.{output_format}"
+    if output_format == 'webp':
+        image.save(output_path, quality=output_quality, method=2)
+    elif output_format != 'png':
+        image.save(output_path, quality=output_quality)
+    else:
+        image.save(output_path)
+    return Path(output_path)
+
 class Predictor(BasePredictor):
     def setup(self) -> None:
         start = time.time()
 
         self.weights_cache = WeightsDownloadCache()
         self.last_loaded_loras = {}
+        self.loaded_lora_adapters = set()
 
-        print("Loading safety checker...")
-        if not os.path.exists(SAFETY_CACHE):
-            download_weights(SAFETY_URL, SAFETY_CACHE)
-        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-            SAFETY_CACHE, torch_dtype=torch.float16
-        ).to("cuda")
         self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
 
         print("Loading Stable Diffusion txt2img Pipeline")
@@ -133,13 +249,13 @@ class Predictor(BasePredictor):
             # Standard SD 1.5 architecture components
             vae = AutoencoderKL.from_pretrained(
                 "stabilityai/sd-vae-ft-mse", 
-                torch_dtype=torch.float16
+                torch_dtype=DTYPE
             ).to("cuda")
             
             text_encoder = CLIPTextModel.from_pretrained(
                 "runwayml/stable-diffusion-v1-5", 
                 subfolder="text_encoder",
-                torch_dtype=torch.float16
+                torch_dtype=DTYPE
             ).to("cuda")
             
             tokenizer = CLIPTokenizer.from_pretrained(
@@ -150,7 +266,7 @@ class Predictor(BasePredictor):
             unet = UNet2DConditionModel.from_pretrained(
                 "runwayml/stable-diffusion-v1-5", 
                 subfolder="unet",
-                torch_dtype=torch.float16
+                torch_dtype=DTYPE
             ).to("cuda")
             
             scheduler = PNDMScheduler.from_pretrained(
@@ -165,7 +281,7 @@ class Predictor(BasePredictor):
                 tokenizer=tokenizer,
                 unet=unet,
                 scheduler=scheduler,
-                safety_checker=self.safety_checker,
+                safety_checker=None,
                 feature_extractor=self.feature_extractor,
                 requires_safety_checker=False
             )
@@ -181,16 +297,43 @@ class Predictor(BasePredictor):
             # Fallback to standard loading method
             self.txt2img_pipe = StableDiffusionPipeline.from_single_file(
                 model_path,
-                torch_dtype=torch.float16,
+                torch_dtype=DTYPE,
                 variant="fp16",
-                use_safetensors=True
+                use_safetensors=True,
+                safety_checker=None
             ).to("cuda")
 
+        self.tokenizer = self.txt2img_pipe.tokenizer
         patch_unet_get_aug_embed(self.txt2img_pipe.unet)
         self.txt2img_pipe.__class__.load_lora_into_transformer = classmethod(
             load_lora_into_transformer
         )
 
+        # SDPA attention and DPM-Solver++ from the start; img2img shares both below
+        self.txt2img_pipe.unet.set_attn_processor(AttnProcessor2_0())
+        self.txt2img_pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+            self.txt2img_pipe.scheduler.config,
+            algorithm_type="dpmsolver++",
+            use_karras_sigmas=True
+        )
+
+        # Decode in tiles, one image at a time, to cap the VAE's peak VRAM (img2img shares this VAE)
+        self.txt2img_pipe.vae.enable_tiling()
+        self.txt2img_pipe.vae.enable_slicing()
+
+        # Only requests without LoRAs use the compiled UNet: injected PEFT layers and
+        # per-request adapter scales would recompile it (and record new CUDA graphs)
+        # on every swap until dynamo gives up. See use_compiled_unet().
+        self.compiled_unet_forward = torch.compile(
+            self.txt2img_pipe.unet.forward, mode="reduce-overhead", fullgraph=False
+        )
+        self.use_compiled_unet(True)
+        # Compile the decoder module rather than vae.decode, whose Python-level
+        # slicing/tiling loops dynamo would unroll and re-specialize for every
+        # batch size and image size. No CUDA graphs: callers of the decoder keep
+        # earlier outputs alive across calls, which graph replays would overwrite.
+        self.txt2img_pipe.vae.decoder.compile(fullgraph=False)
+
         print("Loading Stable Diffusion img2img pipeline")
         self.img2img_pipe = StableDiffusionImg2ImgPipeline(
             vae=self.txt2img_pipe.vae,
@@ -198,26 +341,75 @@ class Predictor(BasePredictor):
             tokenizer=self.txt2img_pipe.tokenizer,
             unet=self.txt2img_pipe.unet,
             scheduler=self.txt2img_pipe.scheduler,
-            safety_checker=self.txt2img_pipe.safety_checker,
+            safety_checker=None,
             feature_extractor=self.txt2img_pipe.feature_extractor,
             requires_safety_checker=False
-        ).to("cuda")
+        )
 
-        patch_unet_get_aug_embed(self.img2img_pipe.unet)
+        # The UNet is shared with txt2img and already patched above
         self.img2img_pipe.__class__.load_lora_into_transformer = classmethod(
             load_lora_into_transformer
         )
-        
+
+        # Every component is on cuda:0 by now, so predict() never moves the pipelines
+        torch.cuda.set_device(0)
+
+        # Reused across requests and reseeded, instead of a new CUDA generator per call
+        self.generator_pool = [torch.Generator(device="cuda") for _ in range(4)]
+        self.generator_index = 0
+
+        # One short run at the default 1:1 size, decoded to images, so cuDNN
+        # autotuning, allocator growth and the first UNet/decoder compiles happen
+        # here, not on the first request. Don't follow this (or any request) with
+        # torch.cuda.empty_cache(): it rescans the allocator and hands back memory
+        # the next request just has to reallocate.
+        print("Warming up pipeline")
+        width, height = ASPECT_RATIOS["1:1"]
+        with torch.inference_mode():
+            self.txt2img_pipe(
+                prompt="warmup",
+                num_inference_steps=2,
+                width=width,
+                height=height,
+                output_type="pil",
+            )
+
         print("setup took:", time.time() - start)
 
+    def use_compiled_unet(self, enabled):
+        """
+        Route the shared UNet through the compiled forward, or back to eager.
+        Only enable it while no LoRA adapters are injected.
+        """
+        unet = self.txt2img_pipe.unet
+        if enabled:
+            unet.forward = self.compiled_unet_forward
+        else:
+            vars(unet).pop("forward", None)
+
+    @functools.cached_property
+    def safety_checker(self):
+        # Loaded on first use: the checker is off by default, so most processes never need it.
+        # It is kept on the CPU and only moved to the GPU while it runs.
+        print("Loading safety checker...")
+        if not os.path.exists(SAFETY_CACHE):
+            download_weights(SAFETY_URL, SAFETY_CACHE)
+        return StableDiffusionSafetyChecker.from_pretrained(
+            SAFETY_CACHE, torch_dtype=DTYPE
+        )
+
     @torch.amp.autocast('cuda')
     def run_safety_checker(self, image):
         safety_checker_input = self.feature_extractor(image, return_tensors="pt").to("cuda")
-        np_image = [np.array(val) for val in image]
-        image, has_nsfw_concept = self.safety_checker(
-            images=np_image,
-            clip_input=safety_checker_input.pixel_values.to(torch.float16),
-        )
+        np_image = np.stack([np.asarray(val, dtype=np.uint8) for val in image], axis=0)
+        safety_checker = self.safety_checker.to("cuda")
+        try:
+            image, has_nsfw_concept = safety_checker(
+                images=np_image,
+                clip_input=safety_checker_input.pixel_values.to(DTYPE),
+            )
+        finally:
+            safety_checker.to("cpu")
         return image, has_nsfw_concept
 
     def aspect_ratio_to_width_height(self, aspect_ratio: str) -> tuple[int, int]:
@@ -225,78 +417,114 @@ class Predictor(BasePredictor):
 
     def get_image(self, image: str):
         image = Image.open(image).convert("RGB")
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Lambda(lambda x: 2.0 * x - 1.0),
-        ])
-        img: torch.Tensor = transform(image)
-        return img[None, ...]
+        # One host copy into pinned memory; the layout change runs on the GPU and
+        # predict() resizes and normalizes it there
+        arr = np.asarray(image, dtype=np.uint8)
+        img = torch.empty(arr.shape, dtype=torch.uint8, pin_memory=True)
+        img.numpy()[...] = arr
+        return img.to("cuda", non_blocking=True).permute(2, 0, 1).unsqueeze(0)
 
     @staticmethod
     def make_multiple_of_16(n):
-        return ((n + 15) // 16) * 16
+        return (n + 15) & ~15
+
+    def download_lora(self, hf_lora):
+        """
+        Fetch a LoRA to local disk without touching the pipeline.
+        Returns (adapter_name, source) for load_lora_weights, or None if the download failed.
+        """
+        t1 = time.time()
+        lora_path = None
+        # Dispatch on the URL host so at most one pattern is matched per LoRA
+        host = hf_lora.split("/", 3)[2] if hf_lora.startswith(("http://", "https://")) else None
+        # Check for Huggingface Slug lucataco/flux-emoji
+        if host is None and LORA_HF_SLUG_RE.match(hf_lora):
+            print(f"Downloading LoRA weights from - HF path: {hf_lora}")
+            # The weight file is picked by diffusers, so key the slug itself
+            digest = hashlib.blake2b(hf_lora.encode(), digest_size=16).hexdigest()
+        # Check for Replicate tar file
+        elif host == "replicate.delivery" and LORA_REPLICATE_RE.match(hf_lora):
+            print(f"Downloading LoRA weights from - Replicate URL: {hf_lora}")
+            local_weights_cache = self.weights_cache.ensure(hf_lora)
+            lora_path = os.path.join(local_weights_cache, "output/flux_train_replicate/lora.safetensors")
+        # Check for Huggingface URL
+        elif host == "huggingface.co":
+            print(f"Downloading LoRA weights from - HF URL: {hf_lora}")
+            huggingface_slug = LORA_HF_URL_RE.match(hf_lora).group(1)
+            weight_name = hf_lora.split('/')[-1]
+            print(f"HuggingFace slug from URL: {huggingface_slug}, weight name: {weight_name}")
+            lora_path = hf_hub_download(repo_id=huggingface_slug, filename=weight_name)
+        # Check for Civitai URL
+        elif host == "civitai.com" and LORA_CIVITAI_RE.match(hf_lora):
+            # split url to get first part of the url, everythin before '?type'
+            civitai_slug = hf_lora.split('?type')[0]
+            print(f"Downloading LoRA weights from - Civitai URL: {civitai_slug}")
+            lora_path = self.weights_cache.ensure(hf_lora, file=True)
+        # Check for URL to a .safetensors file
+        elif hf_lora.endswith('.safetensors'):
+            print(f"Downloading LoRA weights from - safetensor URL: {hf_lora}")
+            try:
+                lora_path = self.weights_cache.ensure(hf_lora, file=True)
+            except Exception as e:
+                print(f"Error downloading LoRA weights: {e}")
+                return None
+        else:
+            raise Exception(f"Invalid lora, must be either a: HuggingFace path, Replicate model.tar, or a URL to a .safetensors file: {hf_lora}")
+
+        if lora_path is not None:
+            digest = lora_digest(lora_path)
+        print(f"Downloading LoRA took: {time.time() - t1:.2f} seconds")
+        return f"lora_{digest}", lora_path or hf_lora
 
     def load_loras(self, hf_loras, lora_scales):
-        # list of adapter names
-        names = ['a','b','c','d','e','f','g','h','i','j','k','l','m','n','o','p','q','r','s','t','u','v','w','x','y','z']
-        count = 0
-        # loop through each lora
-        for hf_lora in hf_loras:
-            t1 = time.time()
-            # Check for Huggingface Slug lucataco/flux-emoji
-            if re.match(r"^[a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+$", hf_lora):
-                print(f"Downloading LoRA weights from - HF path: {hf_lora}")
-                adapter_name = names[count]
-                count += 1
-                self.txt2img_pipe.load_lora_weights(hf_lora, adapter_name=adapter_name)
-            # Check for Replicate tar file
-            elif re.match(r"^https?://replicate.delivery/[a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+/trained_model.tar", hf_lora):
-                print(f"Downloading LoRA weights from - Replicate URL: {hf_lora}")
-                local_weights_cache = self.weights_cache.ensure(hf_lora)
-                lora_path = os.path.join(local_weights_cache, "output/flux_train_replicate/lora.safetensors")
-                adapter_name = names[count]
-                count += 1
-                self.txt2img_pipe.load_lora_weights(lora_path, adapter_name=adapter_name)
-            # Check for Huggingface URL
-            elif re.match(r"^https?://huggingface.co", hf_lora):
-                print(f"Downloading LoRA weights from - HF URL: {hf_lora}")
-                huggingface_slug = re.search(r"^https?://huggingface.co/([a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+)", hf_lora).group(1)
-                weight_name = hf_lora.split('/')[-1]
-                print(f"HuggingFace slug from URL: {huggingface_slug}, weight name: {weight_name}")
-                adapter_name = names[count]
-                count += 1
-                self.txt2img_pipe.load_lora_weights(huggingface_slug, weight_name=weight_name)
-            # Check for Civitai URL
-            elif re.match(r"^https?://civitai.com/api/download/models/[0-9]+\?type=Model&format=SafeTensor", hf_lora):
-                # split url to get first part of the url, everythin before '?type'
-                civitai_slug = hf_lora.split('?type')[0]
-                print(f"Downloading LoRA weights from - Civitai URL: {civitai_slug}")
-                lora_path = self.weights_cache.ensure(hf_lora, file=True)
-                adapter_name = names[count]
-                count += 1
-                self.txt2img_pipe.load_lora_weights(lora_path, adapter_name=adapter_name)
-            # Check for URL to a .safetensors file
-            elif hf_lora.endswith('.safetensors'):
-                print(f"Downloading LoRA weights from - safetensor URL: {hf_lora}")
-                try:
-                    lora_path = self.weights_cache.ensure(hf_lora, file=True)
-                except Exception as e:
-                    print(f"Error downloading LoRA weights: {e}")
+        # Download every LoRA in parallel first; loading into the pipeline stays serial
+        unique_loras = list(dict.fromkeys(hf_loras))
+        # Pinned until loaded, so one download's eviction can't delete another's files
+        for hf_lora in unique_loras:
+            self.weights_cache.pin(hf_lora)
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                downloads = dict(zip(unique_loras, executor.map(self.download_lora, unique_loras)))
+
+            # Adapters are named after the LoRA's content digest, so a LoRA that is
+            # already loaded (from any URL) is reused instead of read again
+            adapter_names = []
+            adapter_weights = []
+            for hf_lora, lora_scale in zip(hf_loras, lora_scales):
+                if downloads[hf_lora] is None:
                     continue
-                adapter_name = names[count]
-                count += 1
-                self.txt2img_pipe.load_lora_weights(lora_path, adapter_name=adapter_name)
-            else:
-                raise Exception(f"Invalid lora, must be either a: HuggingFace path, Replicate model.tar, or a URL to a .safetensors file: {hf_lora}")
-            t2 = time.time()
-            print(f"Loading LoRA took: {t2 - t1:.2f} seconds")
-        adapter_names = names[:count]
-        adapter_weights = lora_scales[:count]
-        # print(f"adapter_names: {adapter_names}")
-        # print(f"adapter_weights: {adapter_weights}")
-        self.last_loaded_loras = hf_loras
-        self.txt2img_pipe.set_adapters(adapter_names, adapter_weights=adapter_weights)
-            
+                adapter_name, lora_source = downloads[hf_lora]
+                if adapter_name in adapter_names:
+                    print(f"Skipping duplicate LoRA: {hf_lora}")
+                    continue
+                if adapter_name in self.loaded_lora_adapters:
+                    print(f"LoRA already loaded as {adapter_name}")
+                else:
+                    t1 = time.time()
+                    try:
+                        self.txt2img_pipe.load_lora_weights(lora_source, adapter_name=adapter_name)
+                    except Exception:
+                        # A failure part-way can leave the adapter in one component's peft_config,
+                        # which would make every retry fail with "adapter name already in use"
+                        self.txt2img_pipe.delete_adapters([adapter_name])
+                        raise
+                    self.loaded_lora_adapters.add(adapter_name)
+                    print(f"Loading LoRA took: {time.time() - t1:.2f} seconds")
+                adapter_names.append(adapter_name)
+                adapter_weights.append(lora_scale)
+
+            stale_adapters = self.loaded_lora_adapters.difference(adapter_names)
+            if stale_adapters:
+                self.txt2img_pipe.delete_adapters(list(stale_adapters))
+                self.loaded_lora_adapters.difference_update(stale_adapters)
+            # print(f"adapter_names: {adapter_names}")
+            # print(f"adapter_weights: {adapter_weights}")
+            self.last_loaded_loras = hf_loras
+            self.txt2img_pipe.set_adapters(adapter_names, adapter_weights=adapter_weights)
+        finally:
+            for hf_lora in unique_loras:
+                self.weights_cache.unpin(hf_lora)
+
     @torch.inference_mode()
     def predict(
         self,
@@ -360,16 +588,15 @@ class Predictor(BasePredictor):
 
         # Truncate prompt if too long
         original_prompt = prompt
-        prompt = truncate_prompt(prompt)
+        prompt = truncate_prompt(prompt, self.tokenizer)
         if prompt != original_prompt:
-            print(f"Prompt was truncated from {len(original_prompt.split())} to {len(prompt.split())} tokens")
+            print(f"Prompt was truncated to {self.tokenizer.model_max_length} tokens")
 
         width, height = self.aspect_ratio_to_width_height(aspect_ratio)
         max_sequence_length=512
 
         flux_kwargs = {"width": width, "height": height}
         print(f"Prompt: {prompt}")
-        device = self.txt2img_pipe.device
         
         if image:
             pipe = self.img2img_pipe
@@ -389,10 +616,15 @@ class Predictor(BasePredictor):
             width = self.make_multiple_of_16(width)
             height = self.make_multiple_of_16(height)
             print(f"Input image size set to: {width}x{height}")
-            # Resize
-            init_image = init_image.to(device)
-            init_image = torch.nn.functional.interpolate(init_image, (height, width))
-            init_image = init_image.to(torch.bfloat16)
+            # Resize once in the pipeline dtype, then normalize to [-1, 1]
+            init_image = torch.nn.functional.interpolate(
+                init_image.to(DTYPE),
+                (height, width),
+                mode="bilinear",
+                align_corners=False,
+                antialias=True
+            )
+            init_image = init_image.mul_(1.0 / 127.5).sub_(1.0)
             # Set params
             flux_kwargs["image"] = init_image
             flux_kwargs["strength"] = prompt_strength
@@ -404,7 +636,6 @@ class Predictor(BasePredictor):
             flux_kwargs["joint_attention_kwargs"] = {"scale": 1.0}
             # check if loras are new
             if hf_loras != self.last_loaded_loras:
-                pipe.unload_lora_weights()
                 # Check for hf_loras and lora_scales
                 if hf_loras and not lora_scales:
                     # If no lora_scales are provided, use 0.8 for each lora
@@ -417,62 +648,49 @@ class Predictor(BasePredictor):
                 elif hf_loras and len(lora_scales) >= len(hf_loras):
                     # If lora_scales are provided, use them for each lora
                     self.load_loras(hf_loras, lora_scales)
+                else:
+                    # Too few scales for the given loras, so run without any
+                    pipe.unload_lora_weights()
+                    self.loaded_lora_adapters.clear()
+                    self.last_loaded_loras = {}
         else:
             flux_kwargs["joint_attention_kwargs"] = None
             pipe.unload_lora_weights()
+            self.loaded_lora_adapters.clear()
+            self.last_loaded_loras = {}
 
-        # Ensure the pipeline is on GPU
-        pipe = pipe.to("cuda")
+        # Without LoRAs every adapter has just been unloaded and the original modules restored
+        self.use_compiled_unet(not hf_loras)
 
-        generator = torch.Generator("cuda").manual_seed(seed)
+        generator = self.generator_pool[self.generator_index % len(self.generator_pool)]
+        self.generator_index += 1
+        generator.manual_seed(seed)
 
         common_args = {
-            "prompt": [prompt] * num_outputs,
+            # Encoded once and repeated per output by the pipeline
+            "prompt": prompt,
+            "num_images_per_prompt": num_outputs,
             "guidance_scale": guidance_scale,
             "generator": generator,
             "num_inference_steps": num_inference_steps,
             "output_type": "pil"
         }
         
-        # Try with error handling
-        try:
-            output = pipe(
-                **common_args,
-                **flux_kwargs
-            )
-        except RuntimeError as e:
-            print(f"Error during inference: {e}")
-            # If there's a shape mismatch error, try with padding attention
-            if "mat1 and mat2 shapes cannot be multiplied" in str(e):
-                print("Attempting with attention processor patch...")
-                # Apply a patch for cross-attention processors
-                from diffusers.models.attention_processor import AttnProcessor2_0
-                
-                # Switch to standard attention processor
-                pipe.unet.set_attn_processor(AttnProcessor2_0())
-                
-                # Try again with modified pipeline
-                output = pipe(
-                    **common_args,
-                    **flux_kwargs
-                )
-            else:
-                raise e
+        output = pipe(
+            **common_args,
+            **flux_kwargs
+        )
 
         if not disable_safety_checker:
             _, has_nsfw_content = self.run_safety_checker(output.images)
 
-        output_paths = []
+        futures = []
         for i, image in enumerate(output.images):
             if not disable_safety_checker and has_nsfw_content[i]:
                 print(f"NSFW content detected in image {i}")
                 continue
-            output_path = f"/tmp/out-{i}.{output_format}"
-            if output_format != 'png':
-                image.save(output_path, quality=output_quality, optimize=True)
-            else:
-                image.save(output_path)
-            output_paths.append(Path(output_path))
+            futures.append(SAVE_POOL.submit(save_image, image, i, output_format, output_quality))
+        output_paths = [future.result() for future in futures]
 
         if len(output_paths) == 0:
             raise Exception("NSFW content detected. Try running it again, or try a different prompt.")
@@ -3,6 +3,7 @@ import hashlib
 import os
 import shutil
 import subprocess
+import threading
 import time
 
 
@@ -26,18 +27,46 @@ class WeightsDownloadCache:
         self.base_dir = base_dir
         self._hits = 0
         self._misses = 0
+        # Guards the LRU bookkeeping so ensure() can be called from several threads
+        self._lock = threading.Lock()
 
         # Least Recently Used (LRU) cache for paths
         self.lru_paths = deque()
+        # Paths still needed by the caller, never evicted until unpinned
+        self.pinned_paths = set()
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
 
-    def _remove_least_recent(self) -> None:
+    def _remove_least_recent(self) -> bool:
         """
-        Remove the least recently used weights file from the cache and disk.
+        Remove the least recently used unpinned weights file from the cache and disk.
+
+        :return: True if a file was removed, False if every cached path is pinned.
+        """
+        for path in self.lru_paths:
+            if path not in self.pinned_paths:
+                self.lru_paths.remove(path)
+                self._rm_disk(path)
+                return True
+        return False
+
+    def pin(self, url: str) -> None:
+        """
+        Protect the weights for url from eviction until unpin() is called.
+
+        :param url: URL of the weights file, whether or not it is cached yet.
+        """
+        with self._lock:
+            self.pinned_paths.add(self.weights_path(url))
+
+    def unpin(self, url: str) -> None:
+        """
+        Allow the weights for url to be evicted again.
+
+        :param url: URL previously passed to pin().
         """
-        oldest = self.lru_paths.popleft()
-        self._rm_disk(oldest)
+        with self._lock:
+            self.pinned_paths.discard(self.weights_path(url))
 
     def cache_info(self) -> str:
         """
@@ -74,23 +103,30 @@ class WeightsDownloadCache:
 
         This also updates the LRU cache to mark the weights as recently used.
 
+        Safe to call concurrently for distinct URLs; downloads run outside the lock.
+
         :param url: URL to download weights file from, if not in cache.
         :return: Path to weights.
         """
         path = self.weights_path(url)
 
-        if path in self.lru_paths:
-            # here we remove to re-add to the end of the LRU (marking it as recently used)
-            self._hits += 1
-            self.lru_paths.remove(path)
-        else:
-            self._misses += 1
+        with self._lock:
+            cached = path in self.lru_paths
+            if cached:
+                # here we remove to re-add to the end of the LRU (marking it as recently used)
+                self._hits += 1
+                self.lru_paths.remove(path)
+            else:
+                self._misses += 1
+
+        if not cached:
             if file:
                 self.download_weights(url, path, file=True)
             else:
                 self.download_weights(url, path, file=False)
 
-        self.lru_paths.append(path)  # Add file to end of cache
+        with self._lock:
+            self.lru_paths.append(path)  # Add file to end of cache
         return path
 
     def weights_path(self, url: str) -> str:
@@ -113,8 +149,9 @@ class WeightsDownloadCache:
         :param file: If True, download the file as is, otherwise extract it.
         """
         print("Ensuring enough disk space...")
-        while not self._has_enough_space() and len(self.lru_paths) > 0:
-            self._remove_least_recent()
+        with self._lock:
+            while not self._has_enough_space() and self._remove_least_recent():
+                pass
 
         print(f"Downloading weights: {url}")
 